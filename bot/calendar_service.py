@@ -3,52 +3,120 @@ Google Calendar service for checking availability and creating appointments
 """
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest, build_http
 from datetime import datetime, timedelta
 from decouple import config
+import google_auth_httplib2
+import functools
+import threading
 import pytz
+import json
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Portuguese labels for format_date
+_WEEKDAYS = ('Segunda', 'Terça', 'Quarta', 'Quinta', 'Sexta', 'Sábado', 'Domingo')
+_MONTHS = ('Jan', 'Fev', 'Mar', 'Abr', 'Mai', 'Jun', 'Jul', 'Ago', 'Set', 'Out', 'Nov', 'Dez')
+
+
+@functools.lru_cache(maxsize=1)
+def get_calendar_service(cache=None):
+    """Return the process-wide CalendarService, created on first use"""
+    return CalendarService(cache=cache)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_credentials(credentials_file, scopes):
+    """Read the service-account JSON once per process"""
+    with open(credentials_file) as f:
+        info = json.load(f)
+    return service_account.Credentials.from_service_account_info(info, scopes=list(scopes))
+
 
 class CalendarService:
     """Handle Google Calendar operations"""
     
     SCOPES = ['https://www.googleapis.com/auth/calendar']
+    FREEBUSY_CACHE_TTL = 60  # seconds
+    BATCH_SIZE = 50  # Calendar API limit of sub-requests per batch
     
-    def __init__(self):
+    def __init__(self, cache=None):
+        self.cache = cache  # Optional Redis client for FreeBusy results
         self.calendar_id = config('GOOGLE_CALENDAR_ID')
         self.credentials_file = config('GOOGLE_CREDENTIALS_FILE')
         self.timezone = pytz.timezone(config('TIMEZONE', default='America/Sao_Paulo'))
+        self._tz_str = str(self.timezone)  # IANA name sent with every event/query body
+        self._local = threading.local()
         self.service = self._authenticate()
     
     def _authenticate(self):
         """Authenticate with Google Calendar API"""
         try:
-            credentials = service_account.Credentials.from_service_account_file(
-                self.credentials_file,
-                scopes=self.SCOPES
+            self.credentials = _load_credentials(self.credentials_file, tuple(self.SCOPES))
+            # Use the discovery document bundled with the client library
+            # instead of fetching it over HTTP
+            service = build(
+                'calendar', 'v3',
+                http=self._get_http(),
+                requestBuilder=self._build_request,
+                static_discovery=True
             )
-            service = build('calendar', 'v3', credentials=credentials)
             logger.info("Successfully authenticated with Google Calendar")
             return service
         except Exception as e:
             logger.error(f"Failed to authenticate with Google Calendar: {str(e)}")
             raise
     
-    def get_available_dates(self, days_ahead=7):
+    def _get_http(self):
+        """
+        Get this thread's authorized HTTP transport
+        
+        httplib2.Http keeps connections to Google alive between calls but is
+        not thread-safe, so each thread gets its own persistent instance.
+        build_http() gives it the client library's default socket timeout, so
+        a dead kept-alive connection can't hang the calling thread.
+        """
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=build_http())
+            self._local.http = http
+        return http
+    
+    def _build_request(self, http, *args, **kwargs):
+        """Build API requests on the calling thread's pooled transport"""
+        return HttpRequest(self._get_http(), *args, **kwargs)
+    
+    def get_available_dates(self, days_ahead=7, out_slots=None):
         """
         Get list of dates with availability in the next N days
         
         Args:
             days_ahead: Number of days to look ahead
-            
+            out_slots: Optional dict filled with the available slots of each
+                returned date, keyed by the date
+        
         Returns:
             list: List of date objects with availability
         """
         available_dates = []
         today = datetime.now(self.timezone).replace(hour=0, minute=0, second=0, microsecond=0)
         
+        # Fetch busy intervals for the whole window in a single batched FreeBusy
+        # call, shared between patients for a short while through the cache
+        cache_key = f"fb:{self.calendar_id}:{today.date()}:{days_ahead}"
+        busy_intervals = self._get_cached_busy(cache_key)
+        
+        if busy_intervals is None:
+            window_start = today + timedelta(days=1)
+            window_end = today + timedelta(days=days_ahead + 1)
+            response = self._freebusy_batch([(window_start, window_end, self.calendar_id)]).get('0')
+            busy_intervals = self._parse_busy(response, self.calendar_id)
+            if response is not None:
+                self._set_cached_busy(cache_key, busy_intervals)
+        
+        busy_by_date = self._group_busy_by_date(busy_intervals)
+        
         for day_offset in range(1, days_ahead + 1):
             check_date = today + timedelta(days=day_offset)
             
@@ -57,13 +125,22 @@ class CalendarService:
                 continue
             
             # Check if there are any available slots
-            available_slots = self.get_available_slots(check_date)
+            available_slots = self.get_available_slots(
+                check_date,
+                busy_intervals=busy_by_date.get(check_date.date(), [])
+            )
             if available_slots:
                 available_dates.append(check_date)
+                if out_slots is not None:
+                    out_slots[check_date] = available_slots
+                
+                # Max 3 dates for WhatsApp buttons, stop looking once found
+                if len(available_dates) == 3:
+                    break
         
-        return available_dates[:3]  # Return max 3 dates for WhatsApp buttons
+        return available_dates
     
-    def get_available_slots(self, date, slot_duration=30, work_start=9, work_end=17):
+    def get_available_slots(self, date, slot_duration=30, work_start=9, work_end=17, busy_intervals=None):
         """
         Get available time slots for a specific date
         
@@ -72,7 +149,9 @@ class CalendarService:
             slot_duration: Duration of each appointment in minutes
             work_start: Work start hour (24h format)
             work_end: Work end hour (24h format)
-            
+            busy_intervals: Pre-fetched list of (start, end) busy tuples for
+                the date; queried from FreeBusy when not given
+        
         Returns:
             list: List of available time slots as datetime objects
         """
@@ -80,44 +159,216 @@ class CalendarService:
         start_time = date.replace(hour=work_start, minute=0, second=0, microsecond=0)
         end_time = date.replace(hour=work_end, minute=0, second=0, microsecond=0)
         
-        # Get existing events for the day
-        events = self._get_events(start_time, end_time)
+        # Get busy intervals for the day
+        if busy_intervals is None:
+            busy_intervals = self._get_freebusy(start_time, end_time)
         
-        # Generate all possible slots
-        all_slots = []
-        current_slot = start_time
-        while current_slot < end_time:
-            all_slots.append(current_slot)
-            current_slot += timedelta(minutes=slot_duration)
-        
-        # Filter out occupied slots
+        # Walk the working day slot by slot, stopping as soon as 3 free slots
+        # (max for WhatsApp buttons) are found. Slots and busy intervals are
+        # both sorted, so a single pointer sweeps past intervals that ended
+        # before the current slot; the slot is free unless the next interval
+        # starts before the slot ends
+        busy_starts, busy_ends = self._merge_busy(busy_intervals)
+        slot_length = timedelta(minutes=slot_duration)
         available_slots = []
-        for slot in all_slots:
-            slot_end = slot + timedelta(minutes=slot_duration)
-            is_available = True
+        idx = 0
+        current_slot = start_time
+        while current_slot < end_time and len(available_slots) < 3:
+            slot_end = current_slot + slot_length
+            while idx < len(busy_ends) and busy_ends[idx] <= current_slot:
+                idx += 1
             
-            for event in events:
-                event_start = datetime.fromisoformat(event['start'].get('dateTime', event['start'].get('date')))
-                event_end = datetime.fromisoformat(event['end'].get('dateTime', event['end'].get('date')))
-                
-                # Check for overlap
-                if not (slot_end <= event_start or slot >= event_end):
-                    is_available = False
-                    break
+            if idx == len(busy_ends) or busy_starts[idx] >= slot_end:
+                available_slots.append(current_slot)
             
-            if is_available:
-                available_slots.append(slot)
+            current_slot = slot_end
+        
+        return available_slots
+    
+    def _get_freebusy(self, start_time, end_time):
+        """
+        Get busy intervals from calendar between start and end time
+        
+        Args:
+            start_time: datetime object
+            end_time: datetime object
+        
+        Returns:
+            list: List of (start, end) datetime tuples
+        """
+        try:
+            freebusy_result = self.service.freebusy().query(
+                body=self._freebusy_body(start_time, end_time, self.calendar_id)
+            ).execute()
+            
+            intervals = self._parse_busy(freebusy_result, self.calendar_id)
+            logger.info(f"Found {len(intervals)} busy intervals between {start_time} and {end_time}")
+            return intervals
+        
+        except Exception as e:
+            logger.error(f"Error fetching free/busy: {str(e)}")
+            return []
+    
+    def _freebusy_batch(self, ranges):
+        """
+        Run several FreeBusy queries in a single HTTP batch request
+        
+        All sub-requests are packed into one multipart/mixed POST to the
+        Calendar batch endpoint, so N calendars cost one round trip.
+        
+        Args:
+            ranges: List of (start_time, end_time, calendar_id) tuples
+        
+        Returns:
+            dict: Mapping of request id (index in ranges, as str) to the
+                FreeBusy response, or None if that sub-request failed
+        """
+        results = {}
+        
+        def collect(request_id, response, exception):
+            if exception is not None:
+                logger.error(f"Error fetching free/busy for request {request_id}: {str(exception)}")
+            results[request_id] = response
+        
+        batch = self.service.new_batch_http_request(callback=collect)
+        for idx, (start_time, end_time, calendar_id) in enumerate(ranges):
+            batch.add(
+                self.service.freebusy().query(body=self._freebusy_body(start_time, end_time, calendar_id)),
+                request_id=str(idx)
+            )
+        
+        try:
+            batch.execute()
+        except Exception as e:
+            logger.error(f"Error executing free/busy batch: {str(e)}")
+        
+        return results
+    
+    def _freebusy_body(self, start_time, end_time, calendar_id):
+        """Build the request body for a FreeBusy query"""
+        return {
+            'timeMin': start_time.isoformat(),
+            'timeMax': end_time.isoformat(),
+            'timeZone': self._tz_str,
+            'items': [{'id': calendar_id}]
+        }
+    
+    def _parse_busy(self, freebusy_result, calendar_id):
+        """Extract (start, end) datetime tuples from a FreeBusy response"""
+        if not freebusy_result:
+            return []
+        busy = freebusy_result['calendars'][calendar_id].get('busy', [])
+        return [(self._parse_datetime(b['start']), self._parse_datetime(b['end'])) for b in busy]
+    
+    def _get_cached_busy(self, cache_key):
+        """Return cached busy intervals, or None on a cache miss"""
+        if self.cache is None:
+            return None
+        
+        try:
+            cached = self.cache.get(cache_key)
+        except Exception as e:
+            logger.warning(f"Error reading free/busy cache: {str(e)}")
+            return None
+        
+        if cached is None:
+            return None
+        return [
+            (datetime.fromtimestamp(start, self.timezone), datetime.fromtimestamp(end, self.timezone))
+            for start, end in json.loads(cached)
+        ]
+    
+    def _set_cached_busy(self, cache_key, busy_intervals):
+        """
+        Cache busy intervals for FREEBUSY_CACHE_TTL seconds
+        
+        Stored as epoch seconds so cache hits skip ISO-8601 parsing. The key is
+        also tracked in a per-calendar set so invalidation knows what to delete.
+        """
+        if self.cache is None:
+            return
+        
+        try:
+            payload = json.dumps([(int(start.timestamp()), int(end.timestamp())) for start, end in busy_intervals])
+            keys_key = self._busy_cache_keys_key()
+            with self.cache.pipeline(transaction=False) as pipe:
+                pipe.setex(cache_key, self.FREEBUSY_CACHE_TTL, payload)
+                pipe.sadd(keys_key, cache_key)
+                pipe.expire(keys_key, self.FREEBUSY_CACHE_TTL)
+                pipe.execute()
+        except Exception as e:
+            logger.warning(f"Error writing free/busy cache: {str(e)}")
+    
+    def _invalidate_busy_cache(self):
+        """Drop cached busy intervals after the calendar changes"""
+        if self.cache is None:
+            return
+        
+        try:
+            keys_key = self._busy_cache_keys_key()
+            keys = self.cache.smembers(keys_key)
+            self.cache.delete(keys_key, *keys)
+        except Exception as e:
+            logger.warning(f"Error invalidating free/busy cache: {str(e)}")
+    
+    def _busy_cache_keys_key(self):
+        """Redis set holding the cached free/busy keys of this calendar"""
+        return f"fb-keys:{self.calendar_id}"
+    
+    def _group_busy_by_date(self, busy_intervals):
+        """
+        Bucket busy intervals by the local date(s) they cover
+        
+        Args:
+            busy_intervals: List of (start, end) datetime tuples
+        
+        Returns:
+            dict: Mapping of date -> list of (start, end) tuples
+        """
+        busy_by_date = {}
+        for busy_start, busy_end in busy_intervals:
+            day = busy_start.astimezone(self.timezone).date()
+            last_day = busy_end.astimezone(self.timezone).date()
+            while day <= last_day:
+                busy_by_date.setdefault(day, []).append((busy_start, busy_end))
+                day += timedelta(days=1)
+        return busy_by_date
+    
+    @staticmethod
+    def _merge_busy(busy_intervals):
+        """
+        Sort and merge overlapping busy intervals
         
-        return available_slots[:3]  # Return max 3 slots for WhatsApp buttons
+        Args:
+            busy_intervals: List of (start, end) datetime tuples
+        
+        Returns:
+            tuple: (starts, ends) lists, both sorted since intervals are disjoint
+        """
+        starts, ends = [], []
+        for busy_start, busy_end in sorted(busy_intervals):
+            if ends and busy_start <= ends[-1]:
+                ends[-1] = max(ends[-1], busy_end)
+            else:
+                starts.append(busy_start)
+                ends.append(busy_end)
+        return starts, ends
+    
+    @staticmethod
+    def _parse_datetime(value):
+        """Parse an RFC 3339 timestamp returned by the Calendar API"""
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
     
     def _get_events(self, start_time, end_time):
         """
         Get events from calendar between start and end time
         
+        Only used for diagnostics; availability checks use _get_freebusy.
+        
         Args:
             start_time: datetime object
             end_time: datetime object
-            
+        
         Returns:
             list: List of calendar events
         """
@@ -133,7 +384,7 @@ class CalendarService:
             events = events_result.get('items', [])
             logger.info(f"Found {len(events)} events between {start_time} and {end_time}")
             return events
-            
+        
         except Exception as e:
             logger.error(f"Error fetching events: {str(e)}")
             return []
@@ -148,22 +399,84 @@ class CalendarService:
             appointment_type: Type of appointment
             start_time: datetime object for appointment start
             duration: Duration in minutes
-            
+        
         Returns:
             dict: Created event details or None if failed
         """
+        event = self._build_event(patient_name, patient_phone, appointment_type, start_time, duration)
+        
+        try:
+            created_event = self.service.events().insert(
+                calendarId=self.calendar_id,
+                body=event
+            ).execute()
+            
+            logger.info(f"Created appointment: {created_event.get('id')}")
+            self._invalidate_busy_cache()
+            return created_event
+        
+        except Exception as e:
+            logger.error(f"Error creating appointment: {str(e)}")
+            return None
+    
+    def create_appointments_batch(self, appointments):
+        """
+        Create several appointments using Calendar HTTP batch requests
+        
+        Inserts are sent BATCH_SIZE at a time, each group in a single
+        multipart/mixed request instead of one round trip per event.
+        
+        Args:
+            appointments: List of dicts with the create_appointment arguments
+                (patient_name, patient_phone, appointment_type, start_time and
+                optionally duration)
+        
+        Returns:
+            list: Created event details, or None for each insert that failed,
+                in the same order as appointments
+        """
+        events = [self._build_event(**appointment) for appointment in appointments]
+        results = [None] * len(events)
+        
+        def collect(request_id, response, exception):
+            if exception is not None:
+                logger.error(f"Error creating appointment {request_id}: {str(exception)}")
+                return
+            results[int(request_id)] = response
+        
+        for offset in range(0, len(events), self.BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=collect)
+            for idx, event in enumerate(events[offset:offset + self.BATCH_SIZE], offset):
+                batch.add(
+                    self.service.events().insert(calendarId=self.calendar_id, body=event),
+                    request_id=str(idx)
+                )
+            
+            try:
+                batch.execute()
+            except Exception as e:
+                logger.error(f"Error executing appointment batch: {str(e)}")
+        
+        created = sum(1 for event in results if event)
+        logger.info(f"Created {created} of {len(events)} appointments in batch")
+        if created:
+            self._invalidate_busy_cache()
+        return results
+    
+    def _build_event(self, patient_name, patient_phone, appointment_type, start_time, duration=30):
+        """Build the Calendar event body for an appointment"""
         end_time = start_time + timedelta(minutes=duration)
         
-        event = {
+        return {
             'summary': f'{appointment_type} - {patient_name}',
             'description': f'Patient: {patient_name}\nPhone: {patient_phone}\nType: {appointment_type}',
             'start': {
                 'dateTime': start_time.isoformat(),
-                'timeZone': str(self.timezone),
+                'timeZone': self._tz_str,
             },
             'end': {
                 'dateTime': end_time.isoformat(),
-                'timeZone': str(self.timezone),
+                'timeZone': self._tz_str,
             },
             'reminders': {
                 'useDefault': False,
@@ -173,30 +486,10 @@ class CalendarService:
                 ],
             },
         }
-        
-        try:
-            created_event = self.service.events().insert(
-                calendarId=self.calendar_id,
-                body=event
-            ).execute()
-            
-            logger.info(f"Created appointment: {created_event.get('id')}")
-            return created_event
-            
-        except Exception as e:
-            logger.error(f"Error creating appointment: {str(e)}")
-            return None
     
     def format_date(self, date):
         """Format date for display in Portuguese"""
-        weekdays = ['Segunda', 'Terça', 'Quarta', 'Quinta', 'Sexta', 'Sábado', 'Domingo']
-        months = ['Jan', 'Fev', 'Mar', 'Abr', 'Mai', 'Jun', 'Jul', 'Ago', 'Set', 'Out', 'Nov', 'Dez']
-        
-        weekday = weekdays[date.weekday()]
-        day = date.day
-        month = months[date.month - 1]
-        
-        return f"{weekday}, {day} {month}"
+        return f"{_WEEKDAYS[date.weekday()]}, {date.day} {_MONTHS[date.month - 1]}"
     
     def format_time(self, time):
         """Format time for display"""
@@ -1,21 +1,50 @@
 """
 Message handlers for WhatsApp receptionist bot with Google Calendar integration
 """
-from .calendar_service import CalendarService
+from .calendar_service import get_calendar_service
+from .state_store import StateStore
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+# Runs independent network calls of a single message side by side
+executor = ThreadPoolExecutor(thread_name_prefix='handler')
+
+# Messages that (re)start the conversation from the main menu
+_MENU_TRIGGERS = frozenset({'menu', 'start', 'hello', 'hi', 'olá', 'oi'})
+
+# Button titles are limited to 20 characters by WhatsApp
+_MAIN_MENU_BUTTONS = [
+    {'id': 'appointment_1', 'title': 'Consulta Geral'},
+    {'id': 'appointment_2', 'title': 'Consulta Especial'},
+    {'id': 'office_hours', 'title': 'Horários'}
+]
+
+_CONFIRM_BUTTONS = [
+    {'id': 'confirm_yes', 'title': 'Sim, confirmar'},
+    {'id': 'confirm_no', 'title': 'Cancelar'}
+]
+
 
 class MessageHandler:
     """Handles incoming WhatsApp messages and generates responses"""
     
-    # In-memory storage for conversation state and button mappings
-    conversations = {}
-    button_mappings = {}
-    
-    def __init__(self):
-        self.calendar = CalendarService()
+    def __init__(self, twilio_helper=None):
+        self.twilio_helper = twilio_helper
+        self.store = StateStore()
+        self.calendar = get_calendar_service(cache=self.store.redis)
+        
+        # Conversation step -> handler, all called as (from_number, message, button_id, state)
+        self._dispatch = {
+            'menu': self._handle_main_menu,
+            'get_patient_name': self._handle_patient_name,
+            'select_date': self._handle_date_selection,
+            'select_time': self._handle_time_selection,
+            'confirm': self._handle_confirmation,
+        }
     
     def process_message(self, from_number, message_body):
         """
@@ -28,39 +57,26 @@ class MessageHandler:
         Returns:
             dict: Response with 'action', 'body', and optional 'buttons'
         """
-        message = message_body.strip().lower()
-        
-        # Get or initialize conversation state
-        state = self.conversations.get(from_number, {'step': 'menu'})
+        # Keep the typed text (e.g. patient name) and a case-folded copy for matching
+        text = message_body.strip()
+        message = text.lower()
         
         # Handle menu navigation
-        if message in ['menu', 'start', 'hello', 'hi', 'olá', 'oi']:
-            self.conversations[from_number] = {'step': 'menu'}
-            return self._show_main_menu()
+        if message in _MENU_TRIGGERS:
+            response = self._show_main_menu()
+            self.store.save_conversation(from_number, {'step': 'menu'})
+            return response
         
-        # Get button mapping for this user's last message
-        button_map = self.button_mappings.get(from_number, {})
-        button_id = button_map.get(message)
-        
-        # Handle main menu
-        if state['step'] == 'menu':
-            return self._handle_main_menu(from_number, message, button_id)
-        
-        # Handle patient name input
-        elif state['step'] == 'get_patient_name':
-            return self._handle_patient_name(from_number, message_body)
-        
-        # Handle date selection
-        elif state['step'] == 'select_date':
-            return self._handle_date_selection(from_number, message, button_id)
+        # Get or initialize conversation state
+        state = self.store.get_conversation(from_number) or {'step': 'menu'}
         
-        # Handle time selection
-        elif state['step'] == 'select_time':
-            return self._handle_time_selection(from_number, message, button_id)
+        # Match the answer against the buttons sent for this step
+        button_id = self._button_id(self._step_buttons(state), message)
         
-        # Handle confirmation
-        elif state['step'] == 'confirm':
-            return self._handle_confirmation(from_number, message, button_id)
+        # Hand over to the handler of the current step
+        handler = self._dispatch.get(state.get('step'))
+        if handler:
+            return handler(from_number, text, button_id, state)
         
         # Default fallback
         return {
@@ -68,21 +84,86 @@ class MessageHandler:
             'body': "Desculpe, não entendi. Digite 'menu' para voltar ao menu principal."
         }
     
-    def _show_main_menu(self):
-        """Show main menu with appointment types"""
-        buttons = [
-            {'id': 'appointment_1', 'title': 'Consulta Geral'},
-            {'id': 'appointment_2', 'title': 'Consulta Especializada'},
-            {'id': 'office_hours', 'title': 'Horário de Atendimento'}
+    def _step_buttons(self, state):
+        """
+        Rebuild the buttons sent for the conversation's current step
+        
+        Buttons are derived from the step and the options kept in the state,
+        so no per-user button mapping has to be stored.
+        
+        Returns:
+            list: Button dicts with 'id' and 'title' keys
+        """
+        step = state.get('step')
+        if step == 'menu':
+            return _MAIN_MENU_BUTTONS
+        if step == 'select_date':
+            return self._date_buttons([self._int_to_dt(date) for date in state.get('available_dates', [])])
+        if step == 'select_time':
+            return self._time_buttons([self._int_to_dt(slot) for slot in state.get('available_times', [])])
+        if step == 'confirm':
+            return _CONFIRM_BUTTONS
+        return []
+    
+    def _button_id(self, buttons, message):
+        """
+        Get the id of the button answered by message
+        
+        Answers arrive as the typed option number or, for a tapped quick
+        reply, as the button title.
+        
+        Returns:
+            str: Button id, or None if the message doesn't match a button
+        """
+        for idx, btn in enumerate(buttons, 1):
+            if message == str(idx) or message == btn['title'].lower():
+                return btn['id']
+        return None
+    
+    def _date_buttons(self, dates):
+        """Create buttons for available dates"""
+        return [
+            {'id': f'date_{idx}', 'title': self.calendar.format_date(date)}
+            for idx, date in enumerate(dates, 1)
         ]
+    
+    def _time_buttons(self, slots):
+        """Create buttons for available times"""
+        return [
+            {'id': f'time_{idx}', 'title': self.calendar.format_time(slot)}
+            for idx, slot in enumerate(slots, 1)
+        ]
+    
+    def _option_index(self, prefix, message, button_id):
+        """
+        Get the 0-based option chosen by a '<prefix><n>' button or a typed number
         
+        Returns:
+            int: Option index, or None if the message doesn't pick an option
+        """
+        if button_id and button_id.startswith(prefix):
+            return int(button_id.split('_', 1)[1]) - 1
+        if message.isdecimal():
+            return int(message) - 1
+        return None
+    
+    def _dt_to_int(self, dt):
+        """Convert a datetime to epoch seconds for the stored conversation state"""
+        return int(dt.timestamp())
+    
+    def _int_to_dt(self, timestamp):
+        """Convert epoch seconds from the stored conversation state back to a datetime"""
+        return datetime.fromtimestamp(timestamp, self.calendar.timezone)
+    
+    def _show_main_menu(self):
+        """Show main menu with appointment types"""
         return {
             'action': 'send_buttons',
             'body': 'Olá! Bem-vindo à Clínica Dr. Silva 🏥\n\nQual serviço deseja agendar?',
-            'buttons': buttons
+            'buttons': _MAIN_MENU_BUTTONS
         }
     
-    def _handle_main_menu(self, from_number, message, button_id):
+    def _handle_main_menu(self, from_number, message, button_id, state):
         """Handle main menu selection"""
         if button_id in ['appointment_1', 'appointment_2']:
             # Store appointment type and ask for patient name
@@ -91,11 +172,11 @@ class MessageHandler:
                 'appointment_2': 'Consulta Especializada'
             }
             
-            self.conversations[from_number] = {
+            self.store.save_conversation(from_number, {
                 'step': 'get_patient_name',
                 'appointment_type': button_id,
                 'appointment_name': appointment_names[button_id]
-            }
+            })
             
             return {
                 'action': 'send_text',
@@ -121,16 +202,16 @@ Digite 'menu' para voltar ao menu principal."""
             'body': "Por favor, escolha uma opção válida ou digite 'menu'."
         }
     
-    def _handle_patient_name(self, from_number, name):
+    def _handle_patient_name(self, from_number, name, button_id, state):
         """Handle patient name input and show available dates"""
-        state = self.conversations[from_number]
         state['patient_name'] = name
         state['step'] = 'select_date'
-        self.conversations[from_number] = state
+        self.store.save_conversation(from_number, state)
         
         # Get available dates from calendar
         try:
-            available_dates = self.calendar.get_available_dates(days_ahead=14)
+            slots_by_date = {}
+            available_dates = self.calendar.get_available_dates(days_ahead=14, out_slots=slots_by_date)
             
             if not available_dates:
                 return {
@@ -139,19 +220,17 @@ Digite 'menu' para voltar ao menu principal."""
                 }
             
             # Create buttons for available dates
-            buttons = []
-            date_map = {}
-            for idx, date in enumerate(available_dates, 1):
-                formatted_date = self.calendar.format_date(date)
-                buttons.append({
-                    'id': f'date_{idx}',
-                    'title': formatted_date
-                })
-                date_map[str(idx)] = date
+            buttons = self._date_buttons(available_dates)
             
-            # Store date mapping
-            state['available_dates'] = date_map
-            self.conversations[from_number] = state
+            # Store dates in button order, along with each date's slots so
+            # picking a date soon after doesn't need another calendar lookup
+            state['available_dates'] = [self._dt_to_int(date) for date in available_dates]
+            state['prefetched_slots'] = [
+                [self._dt_to_int(slot) for slot in slots_by_date[date]]
+                for date in available_dates
+            ]
+            state['prefetched_at'] = int(time.time())
+            self.store.save_conversation(from_number, state)
             
             return {
                 'action': 'send_buttons',
@@ -166,31 +245,37 @@ Digite 'menu' para voltar ao menu principal."""
                 'body': 'Desculpe, houve um erro ao buscar as datas disponíveis. Tente novamente mais tarde.\n\nDigite "menu" para voltar.'
             }
     
-    def _handle_date_selection(self, from_number, message, button_id):
+    def _handle_date_selection(self, from_number, message, button_id, state):
         """Handle date selection and show available times"""
-        state = self.conversations[from_number]
-        
         # Extract date index from button_id or message
-        date_idx = None
-        if button_id and button_id.startswith('date_'):
-            date_idx = button_id.split('_')[1]
-        elif message.isdigit():
-            date_idx = message
+        available_dates = state.get('available_dates', [])
+        date_idx = self._option_index('date_', message, button_id)
         
-        if not date_idx or date_idx not in state.get('available_dates', {}):
+        if date_idx is None or not 0 <= date_idx < len(available_dates):
             return {
                 'action': 'send_text',
                 'body': 'Por favor, escolha uma data válida ou digite "menu" para voltar.'
             }
         
-        selected_date = state['available_dates'][date_idx]
-        state['selected_date'] = selected_date
+        state['selected_date'] = available_dates[date_idx]
         state['step'] = 'select_time'
-        self.conversations[from_number] = state
+        prefetched = state.pop('prefetched_slots', [])
+        prefetched_at = state.pop('prefetched_at', 0)
+        prefetched_slots = prefetched[date_idx] if date_idx < len(prefetched) else None
         
-        # Get available time slots
+        # Slots found with the date list may have been taken since; only trust
+        # them as long as a cached FreeBusy result would be
+        if time.time() - prefetched_at > self.calendar.FREEBUSY_CACHE_TTL:
+            prefetched_slots = None
+        self.store.save_conversation(from_number, state)
+        selected_date = self._int_to_dt(state['selected_date'])
+        
+        # Get available time slots, reusing recent ones found with the date list
         try:
-            available_slots = self.calendar.get_available_slots(selected_date)
+            if prefetched_slots:
+                available_slots = [self._int_to_dt(slot) for slot in prefetched_slots]
+            else:
+                available_slots = self.calendar.get_available_slots(selected_date)
             
             if not available_slots:
                 return {
@@ -199,19 +284,11 @@ Digite 'menu' para voltar ao menu principal."""
                 }
             
             # Create buttons for available times
-            buttons = []
-            time_map = {}
-            for idx, slot in enumerate(available_slots, 1):
-                formatted_time = self.calendar.format_time(slot)
-                buttons.append({
-                    'id': f'time_{idx}',
-                    'title': formatted_time
-                })
-                time_map[str(idx)] = slot
+            buttons = self._time_buttons(available_slots)
             
-            # Store time mapping
-            state['available_times'] = time_map
-            self.conversations[from_number] = state
+            # Store times in button order
+            state['available_times'] = [self._dt_to_int(slot) for slot in available_slots]
+            self.store.save_conversation(from_number, state)
             
             formatted_date = self.calendar.format_date(selected_date)
             
@@ -228,31 +305,24 @@ Digite 'menu' para voltar ao menu principal."""
                 'body': 'Desculpe, houve um erro ao buscar os horários. Tente novamente.\n\nDigite "menu" para voltar.'
             }
     
-    def _handle_time_selection(self, from_number, message, button_id):
+    def _handle_time_selection(self, from_number, message, button_id, state):
         """Handle time selection and show confirmation"""
-        state = self.conversations[from_number]
-        
         # Extract time index
-        time_idx = None
-        if button_id and button_id.startswith('time_'):
-            time_idx = button_id.split('_')[1]
-        elif message.isdigit():
-            time_idx = message
+        available_times = state.get('available_times', [])
+        time_idx = self._option_index('time_', message, button_id)
         
-        if not time_idx or time_idx not in state.get('available_times', {}):
+        if time_idx is None or not 0 <= time_idx < len(available_times):
             return {
                 'action': 'send_text',
                 'body': 'Por favor, escolha um horário válido ou digite "menu" para voltar.'
             }
         
-        selected_time = state['available_times'][time_idx]
-        state['selected_time'] = selected_time
+        state['selected_time'] = available_times[time_idx]
         state['step'] = 'confirm'
-        self.conversations[from_number] = state
         
         # Show confirmation
-        formatted_date = self.calendar.format_date(state['selected_date'])
-        formatted_time = self.calendar.format_time(selected_time)
+        formatted_date = self.calendar.format_date(self._int_to_dt(state['selected_date']))
+        formatted_time = self.calendar.format_time(self._int_to_dt(state['selected_time']))
         
         confirmation_text = f"""📋 Resumo do Agendamento:
 
@@ -263,37 +333,88 @@ Digite 'menu' para voltar ao menu principal."""
 
 Deseja confirmar este agendamento?"""
         
-        buttons = [
-            {'id': 'confirm_yes', 'title': 'Sim, confirmar'},
-            {'id': 'confirm_no', 'title': 'Cancelar'}
-        ]
+        self.store.save_conversation(from_number, state)
         
         return {
             'action': 'send_buttons',
             'body': confirmation_text,
-            'buttons': buttons
+            'buttons': _CONFIRM_BUTTONS
         }
     
-    def _handle_confirmation(self, from_number, message, button_id):
+    def _handle_confirmation(self, from_number, message, button_id, state):
         """Handle appointment confirmation"""
-        state = self.conversations[from_number]
-        
         if button_id == 'confirm_yes' or message == '1':
-            # Create appointment in Google Calendar
+            # Create appointment in Google Calendar while the patient is told
+            # it is being processed, instead of one call after the other
             try:
-                event = self.calendar.create_appointment(
+                event_future = executor.submit(
+                    self.calendar.create_appointment,
                     patient_name=state['patient_name'],
                     patient_phone=from_number,
                     appointment_type=state['appointment_name'],
-                    start_time=state['selected_time'],
+                    start_time=self._int_to_dt(state['selected_time']),
                     duration=30
                 )
                 
+                if self.twilio_helper:
+                    notice_future = executor.submit(
+                        self.twilio_helper.send_text_message,
+                        from_number,
+                        'Processando seu agendamento...'
+                    )
+                    
+                    # Wait for the notice too so it can't arrive after the reply
+                    wait([event_future, notice_future])
+                    if notice_future.exception():
+                        logger.warning(f"Couldn't send processing notice: {str(notice_future.exception())}")
+                
+                event = event_future.result()
+                
                 if event:
-                    formatted_date = self.calendar.format_date(state['selected_date'])
-                    formatted_time = self.calendar.format_time(state['selected_time'])
+                    formatted_date = self.calendar.format_date(self._int_to_dt(state['selected_date']))
+                    formatted_time = self.calendar.format_time(self._int_to_dt(state['selected_time']))
                     
                     success_message = f"""✅ Agendamento Confirmado!
 
 👤 Paciente: {state['patient_name']}
-🏥 Serviço: {state['appointment_
\ No newline at end of file
+🏥 Serviço: {state['appointment_name']}
+📅 Data: {formatted_date}
+⏰ Horário: {formatted_time}
+
+Você receberá um lembrete 1 dia antes e 1 hora antes da consulta.
+
+Digite 'menu' para fazer um novo agendamento."""
+                    
+                    # Reset conversation
+                    self.store.save_conversation(from_number, {'step': 'menu'})
+                    
+                    return {
+                        'action': 'send_text',
+                        'body': success_message
+                    }
+                
+                return {
+                    'action': 'send_text',
+                    'body': 'Desculpe, não foi possível concluir o agendamento. Tente novamente mais tarde.\n\nDigite "menu" para voltar.'
+                }
+            
+            except Exception as e:
+                logger.error(f"Error creating appointment: {str(e)}")
+                return {
+                    'action': 'send_text',
+                    'body': 'Desculpe, houve um erro ao criar o agendamento. Tente novamente.\n\nDigite "menu" para voltar.'
+                }
+        
+        elif button_id == 'confirm_no' or message == '2':
+            # Cancel and reset conversation
+            self.store.save_conversation(from_number, {'step': 'menu'})
+            
+            return {
+                'action': 'send_text',
+                'body': 'Agendamento cancelado.\n\nDigite "menu" para voltar ao menu principal.'
+            }
+        
+        return {
+            'action': 'send_text',
+            'body': 'Por favor, escolha "Sim, confirmar" ou "Cancelar".'
+        }
\ No newline at end of file
@@ -0,0 +1,55 @@
+"""
+Redis-backed storage for conversation state shared across worker processes
+
+State is stored as plain JSON; handlers keep datetimes in it as epoch seconds.
+
+Every key expires after CONVERSATION_TTL seconds so abandoned conversations
+do not accumulate. The Redis server should also be configured with
+`maxmemory-policy volatile-lru` so sessions are evicted under memory pressure.
+Only keys with a TTL are evicted then, which keeps the Celery queues sharing
+this Redis safe (all app and cache keys here expire).
+"""
+from decouple import config
+import redis
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_TTL = 30 * 60  # 30 minutes
+
+connection_pool = redis.ConnectionPool.from_url(
+    config('REDIS_URL', default='redis://localhost:6379/0'),
+    max_connections=config('REDIS_MAX_CONNECTIONS', default=50, cast=int),
+    decode_responses=True
+)
+redis_client = redis.Redis(connection_pool=connection_pool)
+
+
+class StateStore:
+    """Store conversation state in Redis"""
+    
+    def __init__(self, client=None):
+        self.redis = client or redis_client
+    
+    def get_conversation(self, from_number):
+        """
+        Load conversation state for a WhatsApp number
+        
+        Args:
+            from_number: WhatsApp number of sender
+        
+        Returns:
+            dict: Conversation state, empty if none is stored
+        """
+        return json.loads(self.redis.get(f"conv:{from_number}") or '{}')
+    
+    def save_conversation(self, from_number, state):
+        """
+        Persist conversation state for a WhatsApp number
+        
+        Args:
+            from_number: WhatsApp number of sender
+            state: Conversation state
+        """
+        self.redis.set(f"conv:{from_number}", json.dumps(state), ex=CONVERSATION_TTL)
\ No newline at end of file
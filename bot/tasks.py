@@ -0,0 +1,121 @@
+"""
+Celery tasks for processing WhatsApp messages and sending replies
+"""
+from celery import shared_task
+from django.core.cache import cache
+from twilio.base.exceptions import TwilioRestException
+import threading
+import logging
+
+from .handlers import MessageHandler
+from .twilio_helper import TwilioWhatsAppHelper
+
+logger = logging.getLogger(__name__)
+
+# Handlers are created on first use in each worker process, so importing this
+# module (autoreload, manage.py commands, tests) doesn't need Google or Twilio
+# credentials. The lock makes sure threads racing on the first message share
+# one helper (and one pooled Twilio connection) per process.
+_singletons = {}
+_singletons_lock = threading.Lock()
+
+# How long a number is remembered as unable to receive buttons
+BUTTONS_CAPABILITY_TTL = 24 * 60 * 60  # 1 day
+
+# Twilio error codes meaning the recipient's channel can't receive buttons at
+# all. Only 63005 (channel did not accept content type) qualifies; errors about
+# one payload such as 63021 (channel invalid content, e.g. a title too long),
+# timeouts and 5xx only affect that send and must not disable buttons.
+BUTTONS_UNSUPPORTED_CODES = frozenset({63005})
+
+# Reply sent when a message can't be processed
+ERROR_MSG = 'Desculpe, algo deu errado. Digite "menu" para tentar novamente.'
+
+
+def _get_handlers():
+    """
+    Get the shared MessageHandler and TwilioWhatsAppHelper, creating them once
+    
+    Returns:
+        tuple: (message_handler, twilio_helper)
+    """
+    if not _singletons:
+        with _singletons_lock:
+            if not _singletons:
+                twilio_helper = TwilioWhatsAppHelper()
+                _singletons.update(
+                    message_handler=MessageHandler(twilio_helper=twilio_helper),
+                    twilio_helper=twilio_helper
+                )
+    return _singletons['message_handler'], _singletons['twilio_helper']
+
+
+@shared_task
+def process_whatsapp_message(from_number, message_body):
+    """
+    Process an incoming message and queue the reply
+    
+    Args:
+        from_number: WhatsApp number of sender
+        message_body: Text content of the message
+    """
+    try:
+        message_handler = _get_handlers()[0]
+        
+        # Process the message
+        response = message_handler.process_message(from_number, message_body)
+        
+        logger.info("Action: %s", response.get('action'))
+        
+        # Queue appropriate response
+        if response['action'] == 'send_buttons':
+            dispatch_whatsapp.delay(from_number, response['body'], response['buttons'], 'buttons')
+        
+        elif response['action'] == 'send_text':
+            dispatch_whatsapp.delay(from_number, response['body'], [], 'text')
+    
+    except Exception as e:
+        logger.error("Error processing webhook: %s", e, exc_info=True)
+        
+        # Send error message to user through the same queue as normal replies
+        try:
+            dispatch_whatsapp.delay(from_number, ERROR_MSG, [], 'text')
+        except:
+            pass
+
+
+@shared_task
+def dispatch_whatsapp(from_number, body, buttons, kind):
+    """
+    Send a reply through Twilio
+    
+    Args:
+        from_number: WhatsApp number to reply to
+        body: Message text
+        buttons: List of button dicts with 'id' and 'title' keys
+        kind: 'buttons' to send quick reply buttons, 'text' for plain text
+    """
+    twilio_helper = _get_handlers()[1]
+    
+    if kind == 'buttons':
+        capability_key = f"cap:buttons:{from_number}"
+        
+        if cache.get(capability_key) == 'no':
+            # Buttons already failed for this number, don't try again
+            twilio_helper.send_text_with_options(from_number, body, buttons)
+        
+        else:
+            # Send message with buttons, falling back to numbered options
+            try:
+                twilio_helper.send_message_with_buttons(from_number, body, buttons)
+            except Exception as e:
+                logger.warning("Couldn't send buttons to %s, sending options as text: %s", from_number, e)
+                if isinstance(e, TwilioRestException) and e.code in BUTTONS_UNSUPPORTED_CODES:
+                    cache.set(capability_key, 'no', timeout=BUTTONS_CAPABILITY_TTL)
+                twilio_helper.send_text_with_options(from_number, body, buttons)
+    
+    else:
+        # Send simple text message
+        twilio_helper.send_text_message(from_number, body)
+    
+    logger.info("Response sent to %s", from_number)
\ No newline at end of file
@@ -2,12 +2,57 @@
 Twilio helper for sending WhatsApp messages with dynamic content
 """
 from twilio.rest import Client
+from twilio.http import HttpClient
+from twilio.http.response import Response
 from decouple import config
+import httpx
 import json
 import logging
 
 logger = logging.getLogger(__name__)
 
+# WhatsApp limit on quick-reply button titles
+MAX_BUTTON_TITLE_LENGTH = 20
+
+
+class HttpxHttpClient(HttpClient):
+    """
+    Twilio HTTP client backed by a shared httpx.Client
+    
+    Connections to api.twilio.com are kept alive and, over HTTP/2, concurrent
+    sends from the worker threads are multiplexed on them instead of each
+    paying a TCP/TLS handshake.
+    """
+    
+    def __init__(self, timeout=None, max_connections=50, max_keepalive_connections=20):
+        super().__init__(logger, False, timeout)
+        self.session = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections
+            )
+        )
+    
+    def request(self, method, url, params=None, data=None, headers=None, auth=None, timeout=None, allow_redirects=False):
+        """Make an HTTP request and wrap the result in a Twilio Response"""
+        kwargs = {}
+        if timeout or self.timeout:
+            kwargs['timeout'] = timeout or self.timeout
+        
+        response = self.session.request(
+            method.upper(),
+            url,
+            params=params,
+            data=data,
+            headers=headers,
+            auth=auth,
+            follow_redirects=allow_redirects,
+            **kwargs
+        )
+        
+        return Response(response.status_code, response.text, response.headers)
+
 
 class TwilioWhatsAppHelper:
     """Helper class for sending WhatsApp messages via Twilio"""
@@ -15,9 +60,16 @@ class TwilioWhatsAppHelper:
     def __init__(self):
         self.client = Client(
             config('TWILIO_ACCOUNT_SID'),
-            config('TWILIO_AUTH_TOKEN')
+            config('TWILIO_AUTH_TOKEN'),
+            http_client=HttpxHttpClient()
         )
         self.from_number = config('TWILIO_WHATSAPP_NUMBER')
+        # Content API quick-reply templates by number of buttons, as a template
+        # has a fixed number of actions: {{1}} is the body, {{2}}.. the titles
+        self.buttons_content_sids = {
+            2: config('TWILIO_BUTTONS_CONTENT_SID_2', default=''),
+            3: config('TWILIO_BUTTONS_CONTENT_SID_3', default=''),
+        }
     
     def send_template_message(self, to_number, template_name, language='pt_BR', components=None):
         """
@@ -70,4 +122,46 @@ class TwilioWhatsAppHelper:
             
         except Exception as e:
             logger.error(f"Error sending text message: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+    
+    def send_message_with_buttons(self, to_number, body_text, buttons):
+        """
+        Send message with quick-reply buttons
+        
+        Uses the quick-reply template for this number of buttons
+        (TWILIO_BUTTONS_CONTENT_SID_<n>). Without one, or if a title is too
+        long for a WhatsApp button, the buttons are sent as a numbered list of
+        options.
+        
+        Args:
+            to_number: Recipient WhatsApp number
+            body_text: Message body text
+            buttons: List of dicts with 'id' and 'title'
+        
+        Returns:
+            Message SID
+        """
+        content_sid = self.buttons_content_sids.get(len(buttons))
+        if not content_sid or any(len(btn['title']) > MAX_BUTTON_TITLE_LENGTH for btn in buttons):
+            return self.send_text_with_options(to_number, body_text, buttons)
+        
+        variables = {'1': body_text}
+        for idx, btn in enumerate(buttons, 2):
+            variables[str(idx)] = btn['title']
+        
+        return self.send_template_message(to_number, content_sid, components=variables)
+    
+    def send_text_with_options(self, to_number, body_text, buttons):
+        """
+        Send buttons as a numbered list the user can answer by typing the number
+        
+        Args:
+            to_number: Recipient WhatsApp number
+            body_text: Message body text
+            buttons: List of dicts with 'id' and 'title'
+        
+        Returns:
+            Message SID
+        """
+        options = '\n'.join(f"{idx}. {btn['title']}" for idx, btn in enumerate(buttons, 1))
+        return self.send_text_message(to_number, f"{body_text}\n\n{options}")
\ No newline at end of file
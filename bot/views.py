@@ -1,19 +1,37 @@
 """
 Views for handling WhatsApp webhook
 """
+from django.core.cache import cache
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
+from django_redis import get_redis_connection
+from twilio.request_validator import RequestValidator
+from decouple import config
+import functools
 import logging
 
-from .handlers import MessageHandler
-from .twilio_helper import TwilioWhatsAppHelper
+from .tasks import process_whatsapp_message
 
 logger = logging.getLogger(__name__)
 
-# Initialize handlers
-message_handler = MessageHandler()
-twilio_helper = TwilioWhatsAppHelper()
+# How long a delivered MessageSid is remembered to drop Twilio retries
+MESSAGE_SID_TTL = 5 * 60  # 5 minutes
+
+# Messages accepted per number within RATE_LIMIT_WINDOW seconds
+RATE_LIMIT = config('WEBHOOK_RATE_LIMIT', default=5, cast=int)
+RATE_LIMIT_WINDOW = 1
+_RATE_LIMIT_SCRIPT = """
+local count = redis.call('INCR', KEYS[1])
+if count == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return count
+"""
+
+# Checks the X-Twilio-Signature header; can be turned off for local testing
+validator = RequestValidator(config('TWILIO_AUTH_TOKEN', default=''))
+VALIDATE_SIGNATURE = config('TWILIO_VALIDATE_SIGNATURE', default=True, cast=bool)
 
 
 @csrf_exempt
@@ -21,54 +39,72 @@ twilio_helper = TwilioWhatsAppHelper()
 def whatsapp_webhook(request):
     """
     Handle incoming WhatsApp messages from Twilio
+    
+    The message is handed to a Celery worker so Twilio gets its 200 OK right
+    away instead of waiting on Google Calendar and the reply send. Redeliveries
+    of a MessageSid already seen are acknowledged without processing them again.
+    Requests without a valid Twilio signature are rejected before any work.
     """
-    try:
-        # Get message details from Twilio's POST data
-        from_number = request.POST.get('From', '')
-        message_body = request.POST.get('Body', '')
-        
-        logger.info(f"Received from {from_number}: {message_body}")
-        
-        # Process the message
-        response = message_handler.process_message(from_number, message_body)
-        
-        logger.info(f"Action: {response.get('action')}")
-        
-        # Send appropriate response
-        if response['action'] == 'send_buttons':
-            # Store button mappings for this user
-            button_map = {}
-            for idx, btn in enumerate(response['buttons'], 1):
-                button_map[str(idx)] = btn['id']
-            
-            message_handler.button_mappings[from_number] = button_map
-            
-            # Send message with buttons
-            twilio_helper.send_message_with_buttons(
-                from_number,
-                response['body'],
-                response['buttons']
-            )
-        
-        elif response['action'] == 'send_text':
-            # Send simple text message
-            twilio_helper.send_text_message(from_number, response['body'])
-        
-        logger.info(f"Response sent to {from_number}")
-        
-        # Return 200 OK
+    # Read Twilio's POST data once, for the signature check and the message
+    params = request.POST.dict()
+    
+    if VALIDATE_SIGNATURE and not validator.validate(
+        request.build_absolute_uri(),
+        params,
+        request.META.get('HTTP_X_TWILIO_SIGNATURE', '')
+    ):
+        logger.warning("Rejected webhook request with invalid Twilio signature")
+        return HttpResponse(status=403)
+    
+    # Get message details
+    from_number = params.get('From', '')
+    message_body = params.get('Body', '')
+    message_sid = params.get('MessageSid', '')
+    
+    logger.info("Received from %s: %s", from_number, message_body)
+    
+    if _rate_limited(from_number):
+        # Still 200 so Twilio doesn't retry the dropped message
+        logger.warning("Rate limit exceeded for %s, dropping message", from_number)
+        return HttpResponse(status=200)
+    
+    # cache.add only succeeds for the first delivery, so simultaneous retries
+    # can't both get through
+    sid_key = f"twilio:sid:{message_sid}"
+    if message_sid and not cache.add(sid_key, 1, timeout=MESSAGE_SID_TTL):
+        logger.info("Ignoring duplicate delivery of %s", message_sid)
         return HttpResponse(status=200)
     
-    except Exception as e:
-        logger.error(f"Error processing webhook: {str(e)}", exc_info=True)
-        
-        # Send error message to user
-        try:
-            twilio_helper.send_text_message(
-                from_number,
-                'Desculpe, algo deu errado. Digite "menu" para tentar novamente.'
-            )
-        except:
-            pass
-        
-        return HttpResponse(status=500)
\ No newline at end of file
+    try:
+        process_whatsapp_message.delay(from_number, message_body)
+    except Exception:
+        # Forget the SID so Twilio's retry of this 500 gets processed
+        if message_sid:
+            cache.delete(sid_key)
+        raise
+    
+    # Return 200 OK
+    return HttpResponse(status=200)
+
+
+def _rate_limited(from_number):
+    """
+    Count a message from a number and check it against the rate limit
+    
+    Args:
+        from_number: WhatsApp number of sender
+    
+    Returns:
+        bool: True if the number sent more than RATE_LIMIT messages in the
+            current window
+    """
+    # Run as one script so a counter created by INCR always gets its expiry,
+    # even if the previous window's key expired just before
+    count = _get_rate_limit_script()(keys=[f"rl:{from_number}"], args=[RATE_LIMIT_WINDOW])
+    return count > RATE_LIMIT
+
+
+@functools.lru_cache(maxsize=1)
+def _get_rate_limit_script():
+    """Register the rate limit script on first use, then reuse it (sent by EVALSHA)"""
+    return get_redis_connection('default').register_script(_RATE_LIMIT_SCRIPT)
\ No newline at end of file
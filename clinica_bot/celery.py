@@ -0,0 +1,20 @@
+"""
+Celery application for clinica_bot project.
+
+Message processing and Twilio sends run on Celery workers so the webhook can
+answer Twilio right away. Start a worker with:
+
+    celery -A clinica_bot worker -l info
+"""
+
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'clinica_bot.settings')
+
+app = Celery('clinica_bot')
+
+# Read CELERY_* options from Django settings
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
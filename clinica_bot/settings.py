@@ -61,6 +61,17 @@ DATABASES = {
     }
 }
 
+# Cache (Redis, shared by all workers)
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': config('REDIS_URL', default='redis://localhost:6379/0'),
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    }
+}
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
@@ -75,6 +86,13 @@ TIME_ZONE = config('TIMEZONE', default='America/Sao_Paulo')
 USE_I18N = True
 USE_TZ = True
 
+# Celery (Redis broker; tasks are fire-and-forget, so no result backend).
+# If the broker shares Redis with the app, run it with volatile-lru, not
+# allkeys-lru, so queued messages are never evicted (see bot/state_store.py)
+CELERY_BROKER_URL = config('CELERY_BROKER_URL', default='redis://127.0.0.1:6379/0')
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_TIMEZONE = TIME_ZONE
+
 # Static files
 STATIC_URL = 'static/'
 
@@ -84,6 +102,12 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # CSRF settings for ngrok
 CSRF_TRUSTED_ORIGINS = ['https://*.ngrok.io', 'https://*.ngrok-free.app']
 
+# Behind a proxy that sets X-Forwarded-Proto (e.g. ngrok), trust its scheme so
+# request URLs match the https URL Twilio signs. Only enable it when the proxy
+# is the sole way in, otherwise clients can spoof request.is_secure().
+if config('BEHIND_PROXY', default=False, cast=bool):
+    SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
+
 # Logging
 LOGGING = {
     'version': 1,